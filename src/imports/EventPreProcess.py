@@ -1,6 +1,42 @@
 import cv2
 import numpy as np
 import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from tqdm.auto import tqdm
+from .Events import Events, to_events, slice_events
+
+
+def _signed_pixels(events, im_width):
+    #Flat pixel index and signed polarity weight (+1 positive, -1 negative) of every event
+    flat_idx = events.y.astype(np.intp) * im_width + events.x
+    signed = np.where(events.pol > 0, np.float32(1.0), np.float32(-1.0))
+    return flat_idx, signed
+
+
+def _accumulate_polarity(flat_idx, signed, im_height, im_width):
+    #Sum the signed events into a single frame
+    return np.bincount(flat_idx, weights=signed, minlength=im_height*im_width).reshape(im_height, im_width)
+
+
+def _normalize_images(images):
+    #Scale every image of a stack to [0, 255] using its own min and max, in place for float stacks
+    if images.dtype.kind != 'f':
+        images = images.astype(np.float64)
+    axes = tuple(range(1, images.ndim))
+    images_min = np.min(images, axis=axes, keepdims=True)
+    images_max = np.max(images, axis=axes, keepdims=True)
+    np.subtract(images, images_min, out=images)
+    np.multiply(images, 255, out=images)
+    np.divide(images, images_max - images_min, out=images)
+    return images
+
+
+def _map_frames(func, *frame_lists):
+    #OpenCV releases the GIL, so independent per-frame calls can run on a thread pool
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return list(executor.map(func, *frame_lists))
+
 
 class EventPreProcess:
 
@@ -12,36 +48,37 @@ class EventPreProcess:
         #Channel 2: count of negative events at each pixel position
         #Channel 3: normalized timestamp of events generated at pixel position
         event_images_list = []
+        events = to_events(event_list)
+        x_idx = events.x.astype(np.intp)
+        y_idx = events.y.astype(np.intp)
+        #positive events go to channel 0, negative to channel 1
+        channel = (events.pol <= 0).astype(np.intp)
 
         event_iterator = 0
         time_step = time_steps[-1] - time_steps[-2] 
-        for ts in time_steps:
-            print("Percentage finished: " + str(event_iterator * 100 / len(event_list)))
+        for ts in tqdm(time_steps, desc='concatenating events', unit='step'):
+            #the first event past ts closes the image and is consumed without being counted
+            end = max(np.searchsorted(events.ts, ts, side='right'), event_iterator)
+            if end >= len(events.ts):
+                event_iterator = len(events.ts)
+                break
+
+            xs = x_idx[event_iterator:end]
+            ys = y_idx[event_iterator:end]
+
             event_image = np.zeros((im_height, im_width, 3), dtype=np.float32)
             counter_matrix = np.zeros((im_height, im_width))
             timestamp_matrix = np.zeros((im_height, im_width))
-            
-            for i in range(event_iterator, len(event_list)):
-                event_iterator = i + 1
-                event = np.copy(event_list[i])
-                if event[2] > ts:
-                    event_image[:, :, 2] = np.zeros((im_height, im_width))
-                    event_image[:, :, 2] = np.divide(timestamp_matrix, counter_matrix, where=counter_matrix!=0)
-
-                    event_images_list.append(np.copy(event_image)) 
-                    break
-                else:
-                    if event[3] > 0:
-                        event_image[int(event[1]), int(event[0]), 0] = event_image[int(event[1]), int(event[0]), 0] + 1.0
-                    else:
-                        event_image[int(event[1]), int(event[0]), 1] = event_image[int(event[1]), int(event[0]), 1] + 1.0
-                    
-                    counter_matrix[int(event[1]), int(event[0])] = counter_matrix[int(event[1]), int(event[0])] + 1.0                
 
-                    timestamp_matrix[int(event[1]), int(event[0])] = (np.abs(ts - event[2] - time_step)/time_step) + timestamp_matrix[int(event[1]), int(event[0])]
+            np.add.at(event_image, (ys, xs, channel[event_iterator:end]), 1.0)
+            np.add.at(counter_matrix, (ys, xs), 1.0)
+            np.add.at(timestamp_matrix, (ys, xs), np.abs(ts - events.ts[event_iterator:end] - time_step)/time_step)
+            event_image[:, :, 2] = np.divide(timestamp_matrix, counter_matrix, out=np.zeros((im_height, im_width)), where=counter_matrix!=0)
 
+            event_images_list.append(event_image)
+            event_iterator = end + 1
 
-        return event_images_list, event_list[event_iterator:len(event_list)]
+        return event_images_list, slice_events(event_list, event_iterator)
 
     
     #FrameGeneration static method
@@ -49,81 +86,68 @@ class EventPreProcess:
     def generateFrames(event_list, time_steps, im_height=260, im_width=346, im_channel=1, time_window=None):
         #One Channel
         event_images_list = []
+        events = to_events(event_list)
+        flat_idx, signed = _signed_pixels(events, im_width)
 
         event_iterator = 0
         for ts in time_steps:
-            #print("Percentage finished: " + str(event_iterator * 100 / len(event_list)))
+            #the first event past ts closes the frame and is consumed without being counted
+            end = max(np.searchsorted(events.ts, ts, side='right'), event_iterator)
+            if end >= len(events.ts):
+                event_iterator = len(events.ts)
+                break
+
+            start = event_iterator
+            if time_window is not None:
+                start = max(np.searchsorted(events.ts, ts - time_window, side='right'), start)
+
             event_image = np.zeros((im_height, im_width, im_channel), dtype=np.float32)
-            
-            for i in range(event_iterator, len(event_list)):
-                event_iterator = i + 1
-                event = np.copy(event_list[i]) #[x, y, ts, polarity]
-                if (time_window==None) or (event[2] > ts - time_window):
-                    if event[2] > ts:
-                        event_image[201, 154, 0] = 0
-                        event_images_list.append(np.copy(event_image)) 
-                        break
-                    else:
-                        if event[3] > 0:
-                            event_image[int(event[1]), int(event[0]), 0] = event_image[int(event[1]), int(event[0]), 0] + 1.0
-                        else:
-                            event_image[int(event[1]), int(event[0]), 0] = event_image[int(event[1]), int(event[0]), 0] - 1.0             
-
-        return event_images_list, event_list[event_iterator:len(event_list)]
+            event_image[:, :, 0] = _accumulate_polarity(flat_idx[start:end], signed[start:end], im_height, im_width)
+            event_image[201, 154, 0] = 0
+            event_images_list.append(event_image)
+            event_iterator = end + 1
+
+        return event_images_list, slice_events(event_list, event_iterator)
     
     @staticmethod
     def generateFrames_temporalROI(event_list, time_steps, im_height=260, im_width=346, im_channel=1, time_window=None):
         #One Channel
         event_images_list = []
+        events = to_events(event_list)
+        flat_idx, signed = _signed_pixels(events, im_width)
 
-        event_iterator = 0
-        event_iterator_old = 0
         event_threshold_classifier = 10000
-        event_bus = 0
-        measure = 0
-        for ts in time_steps:
-            measure = measure + 1
+        n_steps = len(time_steps)
+        #every frame takes the next event_threshold_classifier events, the event after them is consumed without being counted
+        chunk_size = event_threshold_classifier + 1
+        n_frames = min(n_steps, len(events.ts) // chunk_size)
+        for i in range(n_frames):
             event_image = np.zeros((im_height, im_width, im_channel), dtype=np.float32)
-            for i in range(event_iterator, len(event_list)):
-                event_iterator = i + 1
-                event = np.copy(event_list[i]) #[x, y, ts, polarity]
-                if event_bus == event_threshold_classifier:
-                    event_image[201, 154, 0] = 0
-                    event_images_list.append(np.copy(event_image))
-                    event_bus = 0
-                    break
-                else:
-                    if event[3] > 0:
-                        event_image[int(event[1]), int(event[0]), 0] = event_image[int(event[1]), int(event[0]), 0] + 1.0
-                    else:
-                        event_image[int(event[1]), int(event[0]), 0] = event_image[int(event[1]), int(event[0]), 0] - 1.0
-                    event_bus = event_bus + 1
-        print(measure)
-
+            event_image[:, :, 0] = _accumulate_polarity(flat_idx[i*chunk_size:i*chunk_size + event_threshold_classifier], signed[i*chunk_size:i*chunk_size + event_threshold_classifier], im_height, im_width)
+            event_image[201, 154, 0] = 0
+            event_images_list.append(event_image)
+        event_iterator = n_frames * chunk_size if n_frames == n_steps else len(events.ts)
 
-        print("event_iterator: ", event_iterator)
-        print("event_list length: ", len(event_list)) 
-        return event_images_list, event_list[event_iterator:len(event_list)]
+        return event_images_list, slice_events(event_list, event_iterator)
 
     #extractEventsByTime static method
     @staticmethod
     def extractEventsByTime(event_list, time_steps, time_window=1e9):
         #Group Events into based on tghe provided list of timestamps
         grouped_events_list = []
+        event_array = np.column_stack(event_list) if isinstance(event_list, Events) else np.asarray(event_list)
+        ts_col = event_array[:, 2]
 
         event_iterator = 0
-        for ts in time_steps:
-            print("Percentage finished: " + str(event_iterator * 100 / len(event_list)))
-            event_group = []
-            
-            for i in range(event_iterator, len(event_list)):
-                event_iterator = i + 1
-                event = np.copy(event_list[i])
-                if (time_window==None) or (event[2] > ts - time_window/2):
-                    event_group.append(event)
-                    if event[2] > ts + time_window/2:
-                        grouped_events_list.append(np.copy(event_group))
-                        break            
+        for ts in tqdm(time_steps, desc='extracting events', unit='step'):
+            #a group spans the events after ts - time_window/2 up to and including the first one past ts + time_window/2
+            start = max(np.searchsorted(ts_col, ts - time_window/2, side='right'), event_iterator)
+            end = max(np.searchsorted(ts_col, ts + time_window/2, side='right'), event_iterator)
+            if end >= len(event_array):
+                break
+
+            grouped_events_list.append(event_array[start:end + 1])
+            event_iterator = end + 1
 
 
         return grouped_events_list
@@ -135,101 +159,95 @@ class EventPreProcess:
         #Channel 1: count of positive events at each pixel position
         #Channel 2: count of negative events at each pixel position
         #Channel 3: normalized timestamp of events generated at pixel position
-        event_images_list = []        
-        ts_min = events[0][2]
+        events = to_events(events)
+        flat_idx, signed = _signed_pixels(events, im_width)
+        ts_min = events.ts[0]
 
+        #a frame is closed by (and includes) the first event past the current window, or by the last event
+        frame_bounds = []
+        start = 0
         time_iterator = 1        
-        event_image = np.zeros((im_height, im_width, im_channel), dtype=np.float32)
-        for i in range(len(events)):
-            event = events[i]
-            if event[3] > 0:
-                event_image[int(event[1]), int(event[0]), 0] = event_image[int(event[1]), int(event[0]), 0] + 1.0
-            else:
-                event_image[int(event[1]), int(event[0]), 0] = event_image[int(event[1]), int(event[0]), 0] - 1.0   
-            
-
-            if (event[2] > (time_iterator * time_window + ts_min)) or (i==(len(events)-1)):
-                event_images_list.append(event_image)
-                event_image = np.zeros((im_height, im_width, im_channel), dtype=np.float32)   
-                time_iterator = time_iterator + 1
-
+        while start < len(events.ts):
+            end = max(np.searchsorted(events.ts, time_iterator * time_window + ts_min, side='right'), start)
+            end = min(end, len(events.ts) - 1) + 1
+            frame_bounds.append((start, end))
+            start = end
+            time_iterator = time_iterator + 1
+
+        n_frames_out = len(frame_bounds)
         if N_frames > 0:
-            while len(event_images_list) < N_frames:
-                event_image = np.zeros((im_height, im_width, im_channel), dtype=np.float32)  
-                event_images_list.append(event_image)
-            
-            while len(event_images_list) > N_frames:
-                del event_images_list[0]
-
-        
+            #keep the last N_frames frames, missing frames stay as zero padding at the end
+            frame_bounds = frame_bounds[-N_frames:]
+            n_frames_out = N_frames
 
+        event_images = np.zeros((n_frames_out, im_height, im_width, im_channel), dtype=np.float32)
+        for event_image, (start, end) in zip(event_images, frame_bounds):
+            event_image[:, :, 0] = _accumulate_polarity(flat_idx[start:end], signed[start:end], im_height, im_width)
 
-        return event_images_list
+        return list(event_images)
 
 
     #cropFrames static method
     @staticmethod
     def cropFrames(image_list, circle_center=(173, 130), circle_rad=100, im_height=260, im_width=346, im_channels=1, expand_dims=False):
         
-        cropped_image_list = []
-        i=0
-        for image in image_list:
-            mask = np.zeros((im_height, im_width, im_channels), dtype=np.float32)            
-            cv2.circle(mask, circle_center, circle_rad, [1]*im_channels, -1, 8, 0)
-            cropped_image = np.multiply(mask, image)
+        if len(image_list) == 0:
+            return []
+
+        mask = np.zeros((im_height, im_width, im_channels), dtype=np.float32)            
+        cv2.circle(mask, circle_center, circle_rad, [1]*im_channels, -1, 8, 0)
 
-            if expand_dims:
-                cropped_image_list.append(np.expand_dims(np.copy(cropped_image), axis=2)) 
-            else:
-                cropped_image_list.append(np.copy(cropped_image)) 
+        #mask the whole stack at once, the mask broadcasts over the image axis
+        cropped_images = np.multiply(mask, np.asarray(image_list))
 
-        return cropped_image_list
+        if expand_dims:
+            cropped_images = np.expand_dims(cropped_images, axis=3)
+
+        return list(cropped_images)
 
     #rotateFrames static method
     @staticmethod
     def rotateFrames(image_list, circle_center=(173, 130), rotate_angle=90, im_height=260, im_width=346, expand_dims=False):
         
-        rotated_image_list = []
+        if len(image_list) == 0:
+            return []
 
-        for image in image_list:
-            rot_mat = cv2.getRotationMatrix2D(circle_center, rotate_angle, 1.0)
-            #rotated_image = cv2.warpAffine(image[:,:,0], rot_mat, image.shape[1::-1], flags=cv2.INTER_LINEAR)
-            rotated_image = cv2.warpAffine(image, rot_mat, image.shape[1::-1], flags=cv2.INTER_LINEAR)
+        rot_mat = cv2.getRotationMatrix2D(circle_center, rotate_angle, 1.0)
+
+        #warpAffine drops a trailing single channel axis, rotate every image straight into its slot of one output array
+        frame_shape = np.shape(image_list[0])
+        if len(frame_shape) == 3 and frame_shape[2] == 1:
+            frame_shape = frame_shape[:2]
+        rotated_images = np.empty((len(image_list),) + frame_shape, dtype=np.asarray(image_list[0]).dtype)
+
+        def rotate(image, rotated_image):
+            cv2.warpAffine(image, rot_mat, image.shape[1::-1], dst=rotated_image, flags=cv2.INTER_LINEAR)
+
+        _map_frames(rotate, image_list, rotated_images)
 
-            if expand_dims:
-                rotated_image_list.append(np.expand_dims(np.copy(rotated_image), axis=2)) 
-            else:
-                rotated_image_list.append(np.copy(rotated_image))
+        if expand_dims:
+            rotated_images = np.expand_dims(rotated_images, axis=3)
 
-        return rotated_image_list
+        return list(rotated_images)
 
 
     #updateContactStatus static method
     @staticmethod
     def updateContactStatus(list_of_current_contact_status, list_of_rotations, rotation_angle):
         
-        list_of_rotated_contact_status = []
+        contact_status = np.asarray(list_of_current_contact_status).astype(int)
+        rotations = np.asarray(list_of_rotations)[:, 0:2]
 
         rot_mat = np.array([ [math.cos(rotation_angle*math.pi/180), math.sin(rotation_angle*math.pi/180)], [-math.sin(rotation_angle*math.pi/180), math.cos(rotation_angle*math.pi/180)] ])
 
-        for contact_status in list_of_current_contact_status:
-            if contact_status == 0:
-                list_of_rotated_contact_status.append(0)
-            else:
-                current_rotation = list_of_rotations[int(contact_status)-1]
-                rotated_contact_status = np.matmul(rot_mat, current_rotation[0:2])
-                best_rot_diff = 100
-                best_rot_idx = 1
-                i = 1
-                for rot in list_of_rotations:
-                    diff_vals = np.sqrt( np.power(rot[0] - rotated_contact_status[0], 2) +  np.power(rot[1] - rotated_contact_status[1], 2))
-                    if best_rot_diff > diff_vals:
-                        best_rot_diff = diff_vals
-                        best_rot_idx = i
-                    i = i + 1
-
-                list_of_rotated_contact_status.append(best_rot_idx)
+        #rotate every contact's rotation vector and snap it to the closest one in list_of_rotations (1-indexed, 0 means no contact)
+        in_contact = contact_status != 0
+        rotated_contact_status = rotations[contact_status[in_contact] - 1] @ rot_mat.T
+        sq_dist = np.sum((rotated_contact_status[:, None, :] - rotations[None, :, :])**2, axis=2)
 
+        list_of_rotated_contact_status = np.zeros(len(contact_status), dtype=int)
+        list_of_rotated_contact_status[in_contact] = np.argmin(sq_dist, axis=1) + 1
+        list_of_rotated_contact_status = list_of_rotated_contact_status.tolist()
 
         return list_of_rotated_contact_status
 
@@ -239,28 +257,24 @@ class EventPreProcess:
         #The time of the first bin should correspond to the elements in time_steps
 
         event_images_list = []
+        events = to_events(event_list)
 
         event_leading_iterator = 0    
         event_trailing_iterator = 0
 
-        for ts in time_steps:
-            print("Percentage finished: %d", event_leading_iterator / len(event_list))
+        for ts in tqdm(time_steps, desc='binning events', unit='step'):
             event_image = np.zeros((im_height, im_width, n_bin), dtype=np.float64)
             
-            for i in range(event_leading_iterator, len(event_list)):
-                event = np.copy(event_list[i])
-                if event[2] > ts:
-                    event_leading_iterator = i
-                    break
-            for i in range(event_trailing_iterator, event_leading_iterator):
-                event = np.copy(event_list[i])
-                if event[2] > (ts - n_bin*bin_step_size):
-                    event_trailing_iterator = i
-                    break
-            for i in range(event_trailing_iterator, event_leading_iterator):
-                event = np.copy(event_list[i])
-                channel = np.floor((ts - event[2]) / bin_step_size )
-                event_image[int(event[1]), int(event[0]), int(channel)] = event_image[int(event[1]), int(event[0]), int(channel)] + event[3]
+            #both iterators move to the first event past their bound, and stay put if there is none
+            leading = max(np.searchsorted(events.ts, ts, side='right'), event_leading_iterator)
+            if leading < len(events.ts):
+                event_leading_iterator = leading
+            trailing = max(np.searchsorted(events.ts, ts - n_bin*bin_step_size, side='right'), event_trailing_iterator)
+            if trailing < event_leading_iterator:
+                event_trailing_iterator = trailing
+            window = slice_events(events, event_trailing_iterator, event_leading_iterator)
+            channel = np.floor((ts - window.ts) / bin_step_size ).astype(np.intp)
+            np.add.at(event_image, (window.y.astype(np.intp), window.x.astype(np.intp), channel), window.pol)
 
             event_images_list.append(event_image)
 
@@ -286,74 +300,75 @@ class EventPreProcess:
 
     def EdgeDetection(image_list, canny_threshold_1=100, canny_threshold_2=100, convert=False):
         #Apply Canny Edge Detection to a list of images
-        edge_images = []
+        temp_images = np.array(image_list)
+        np.nan_to_num(temp_images, copy=False, nan=0.0)
+        if convert:
+            temp_images = np.uint8(_normalize_images(temp_images))
 
-        for image in image_list:
-            temp_image = np.copy(image)
-            temp_image[np.isnan(temp_image)] = 0
-            if convert:
-                temp_image = np.uint8(255 * (temp_image - np.min(temp_image)) / (np.max(temp_image) - np.min(temp_image)))
-            edge_images.append(cv2.Canny(temp_image, canny_threshold_1, canny_threshold_2))
+        edge_images = _map_frames(lambda temp_image: cv2.Canny(temp_image, canny_threshold_1, canny_threshold_2), temp_images)
 
         return edge_images
         
     def ErodeImages(image_list, kernel_size=5, binary_format=False):
         #Erode a list of images
-        eroded_images = []
         erosion_kernel = np.ones((kernel_size, kernel_size), np.uint8)
 
-        for image in image_list:
-            temp_image = np.copy(image)
-            temp_image[np.isnan(temp_image)] = 0.0
-            temp_image = 255 * (temp_image - np.min(temp_image)) / (np.max(temp_image) - np.min(temp_image))
+        temp_images = np.array(image_list)
+        np.nan_to_num(temp_images, copy=False, nan=0.0)
+        temp_images = _normalize_images(temp_images)
+
+        def erode(temp_image):
             eroded_image = cv2.erode(temp_image, erosion_kernel)
             if binary_format:
                 eroded_image[eroded_image>0] = 1
-            eroded_images.append(eroded_image)
+            return eroded_image
+
+        eroded_images = _map_frames(erode, temp_images)
 
         return eroded_images
 
     def DiluteImages(image_list, kernel_size=5, binary_format=False):
         #Dilate a list of images
-        diluted_images = []
         dilate_kernel = np.ones((kernel_size, kernel_size), np.uint8)
 
-        for image in image_list:
-            temp_image = np.copy(image)
-            temp_image[np.isnan(temp_image)] = 0.0
-            if binary_format:
-                temp_image = 255 * (temp_image - np.min(temp_image)) / (np.max(temp_image) - np.min(temp_image))
+        temp_images = np.array(image_list)
+        np.nan_to_num(temp_images, copy=False, nan=0.0)
+        if binary_format:
+            temp_images = _normalize_images(temp_images)
+
+        def dilate(temp_image):
             diluted_image = cv2.dilate(temp_image, dilate_kernel)
             if binary_format:
                 diluted_image[diluted_image>0] = 1
-            diluted_images.append(diluted_image)
+            return diluted_image
+
+        diluted_images = _map_frames(dilate, temp_images)
 
         return diluted_images
 
     def BinaryAddImages(image_list_1, image_list_2):
         #Binary add two list of images
-        summed_images = []
         size = np.min([len(image_list_1), len(image_list_2)])
+        summed_images = np.logical_or(np.asarray(image_list_1[:size]), np.asarray(image_list_2[:size]))
         
-        for i in range(size):
-            summed_images.append(np.logical_or(image_list_1[i], image_list_2[i]))
-        
-        return summed_images
+        return list(summed_images)
 
     def MultiplyImages(image_list_1, image_list_2):
         #Multiply two list of images (for masking)
 
-        multiplied_images = []
         size = np.min([len(image_list_1), len(image_list_2)])
-        for i in range(size):
-            multiplied_images.append(np.multiply(image_list_1[i], image_list_2[i]))
+        multiplied_images = np.multiply(np.asarray(image_list_1[:size]), np.asarray(image_list_2[:size]))
         
-        return multiplied_images
+        return list(multiplied_images)
 
 
     def FlipImages(image_list, axis=0):
         #flip image vertically (axis=0) or horizontally (axis=1)
 
+        if isinstance(image_list, np.ndarray):
+            #stacked images flip as a single view, skipping the image axis
+            return np.flip(image_list, axis + 1)
+
         flipped_image_list = []
 
         for image in image_list:
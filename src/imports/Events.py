@@ -0,0 +1,28 @@
+from collections import namedtuple
+import numpy as np
+
+#Event stream stored as one contiguous, typed array per field
+Events = namedtuple('Events', 'x y ts pol')
+
+
+def to_events(event_list):
+    #Convert [x, y, ts, polarity] rows (list, ndarray or dask array) into Events, Events are passed through as is
+    if isinstance(event_list, Events):
+        return event_list
+
+    event_list = np.asarray(event_list).reshape(-1, 4)
+    #timestamps are kept integer (ns) unless they come in as floats
+    ts_dtype = np.int64 if np.issubdtype(event_list.dtype, np.integer) else np.float64
+    return Events(
+        x=np.ascontiguousarray(event_list[:, 0], dtype=np.int16),
+        y=np.ascontiguousarray(event_list[:, 1], dtype=np.int16),
+        ts=np.ascontiguousarray(event_list[:, 2], dtype=ts_dtype),
+        pol=np.ascontiguousarray(event_list[:, 3], dtype=np.int8),
+    )
+
+
+def slice_events(event_list, start, stop=None):
+    #Slice rows of an event list, or every field of Events
+    if isinstance(event_list, Events):
+        return Events(*[field[start:stop] for field in event_list])
+    return event_list[start:stop]
@@ -7,10 +7,29 @@ import pandas as pd
 from tqdm.auto import tqdm
 import numpy as np
 import h5py
+from .Events import Events, to_events
+
+#per-column layout of the parsed events in events.h5
+EVENT_COLUMNS = {'x': np.int16, 'y': np.int16, 'ts': np.int64, 'pol': np.int8}
+#number of events buffered in memory before being appended to events.h5
+EVENT_BATCH = 1 << 20
+
+def _append_events(datasets, columns, n):
+    #append the first n buffered events to the resizable per-column datasets
+    if n == 0:
+        return
+    for name, dataset in datasets.items():
+        start = dataset.shape[0]
+        dataset.resize(start + n, axis=0)
+        dataset[start:start + n] = columns[name][:n]
 
 class TactileBag:
     def __init__(self, path) -> None:
         self.path = Path(path).resolve()
+        #events.h5 is opened lazily on first access and kept open
+        self._events_file = None
+        self._events = None
+        self._event_columns = None
     
     def parse(self, possible_angles, N_examples, theta, N_iters=12, z_thresh=-0.0037, min_z=-0.015, max_z=0.035, start_time=0):
         params = {
@@ -39,25 +58,42 @@ class TactileBag:
         # parsing both events and other variables seems to use a lot of memory for some reason.
         # seperating this parsing does not use as much memory
         ############## parse events
-        events = []
         contact_status = []
         contact_status_ts = []
         contact_angle = []
         contact_angle = []
         topics = ['/dvs/events']
 
-        for topic, msg, t in tqdm(
-            bag_file.read_messages(topics=topics), 
-            total=sum([bag_file.get_message_count(top) for top in topics]),
-            desc='parsing events',
-            unit='msg'
-        ):
-            if topic == '/dvs/events':
-                ev_array = []
-                for e in msg.events:
-                    event = [e.x, e.y, e.ts.to_nsec(), e.polarity]
-                    ev_array.append(event)
-                events.append(da.array(ev_array))
+        # events are streamed to events.h5 in batches so the whole trace is never held in memory
+        self.clear_cache()
+        with h5py.File(self.path / 'events.h5', 'w') as f:
+            datasets = {
+                name: f.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(EVENT_BATCH,), compression='lzf') 
+                for name, dtype in EVENT_COLUMNS.items()
+            }
+            columns = {name: np.empty(EVENT_BATCH, dtype=dtype) for name, dtype in EVENT_COLUMNS.items()}
+            n_buffered = 0
+
+            for topic, msg, t in tqdm(
+                bag_file.read_messages(topics=topics), 
+                total=sum([bag_file.get_message_count(top) for top in topics]),
+                desc='parsing events',
+                unit='msg'
+            ):
+                if topic == '/dvs/events':
+                    n = len(msg.events)
+                    if n_buffered + n > len(columns['x']):
+                        _append_events(datasets, columns, n_buffered)
+                        n_buffered = 0
+                        if n > len(columns['x']): #single message larger than a batch
+                            columns = {name: np.empty(n, dtype=dtype) for name, dtype in EVENT_COLUMNS.items()}
+                    columns['x'][n_buffered:n_buffered + n] = [e.x for e in msg.events]
+                    columns['y'][n_buffered:n_buffered + n] = [e.y for e in msg.events]
+                    columns['ts'][n_buffered:n_buffered + n] = [e.ts.to_nsec() for e in msg.events]
+                    columns['pol'][n_buffered:n_buffered + n] = [e.polarity for e in msg.events]
+                    n_buffered += n
+
+            _append_events(datasets, columns, n_buffered)
 
         ########## parse other
         topics = ['/contact_status', '/contact_angle']
@@ -68,11 +104,7 @@ class TactileBag:
             desc='parsing other',
             unit='msg'
         ):
-            if topic == '/dvs/events':
-                for e in msg.events:
-                    event = [e.x, e.y, e.ts.to_nsec(), e.polarity]
-                    events.append(event)
-            elif topic == '/contact_status':
+            if topic == '/contact_status':
                 contact_status.append(msg.data)
                 contact_status_ts.append(t.to_nsec())
             elif topic == '/contact_angle':
@@ -95,9 +127,6 @@ class TactileBag:
             }
         )
 
-        da_event = da.vstack(events)
-        da_event.to_hdf5(self.path / 'events.h5', 'events')
-
         df.to_csv(self.path / 'parsed_bag.csv', index=False)
 
     def is_parsed(self):
@@ -109,6 +138,14 @@ class TactileBag:
     def parse_exception(self):
         raise Exception('Bag not parsed yet. Call parse before loading.')
 
+    def clear_cache(self):
+        #close events.h5 and drop the cached events
+        if self._events_file is not None:
+            self._events_file.close()
+        self._events_file = None
+        self._events = None
+        self._event_columns = None
+
     @property
     def params(self):
         if not self.is_parsed():
@@ -123,7 +160,28 @@ class TactileBag:
     def events(self):
         if not self.is_parsed():
             self.parse_exception()
-        return da.array(h5py.File(self.path / 'events.h5', 'r')['events'])
+        if self._events is None:
+            self._events_file = h5py.File(self.path / 'events.h5', 'r')
+            f = self._events_file
+            #one dask chunk per hdf5 chunk keeps the graph small and every task reading whole chunks
+            if 'events' in f: #bags parsed before events were stored per column
+                self._events = da.from_array(f['events'], chunks=(EVENT_BATCH, 4))
+            else:
+                self._events = da.stack([da.from_array(f[name], chunks=(EVENT_BATCH,)) for name in EVENT_COLUMNS], axis=1)
+        return self._events
+
+    @property
+    def event_columns(self):
+        #events loaded as contiguous typed columns, the layout EventPreProcess works on
+        if not self.is_parsed():
+            self.parse_exception()
+        if self._event_columns is None:
+            with h5py.File(self.path / 'events.h5', 'r') as f:
+                if 'events' in f: #bags parsed before events were stored per column
+                    self._event_columns = to_events(f['events'][...])
+                else:
+                    self._event_columns = Events(*[f[name][...] for name in EVENT_COLUMNS])
+        return self._event_columns
 
     @property
     def parsed_bag(self):
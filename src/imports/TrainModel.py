@@ -1,4 +1,5 @@
 import json
+import contextlib
 import torch
 import torch_geometric as pyg
 from tqdm.auto import tqdm, trange  
@@ -22,9 +23,12 @@ class TrainModel():
         features = 'all',
         weight_decay=0,
         patience=10,
-        batch = 1,
+        batch = 32,
         augment=False,
-        seed=0
+        seed=0,
+        debug_anomaly=False,
+        amp=True,
+        num_workers=4
         ):
 
         self.extraction_case_dir = Path(extraction_case_dir)
@@ -34,12 +38,22 @@ class TrainModel():
         self.val_data = TactileDataset(self.extraction_case_dir / 'val', features=features)
         self.test_data = TactileDataset(self.extraction_case_dir / 'test', features=features)
 
-        self.train_loader = pyg.loader.DataLoader(self.train_data, shuffle=True, batch_size=batch)
-        self.val_loader = pyg.loader.DataLoader(self.val_data)
-        self.test_loader = pyg.loader.DataLoader(self.test_data)
+        self.device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
+        #pinned host memory lets batches be copied to the gpu asynchronously
+        loader_kwargs = {
+            'pin_memory': self.device.type == 'cuda',
+            'num_workers': num_workers
+        }
+        #train and val are iterated every epoch, keep their workers alive between epochs
+        self.train_loader = pyg.loader.DataLoader(self.train_data, shuffle=True, batch_size=batch, persistent_workers=num_workers > 0, **loader_kwargs)
+        self.val_loader = pyg.loader.DataLoader(self.val_data, batch_size=batch, persistent_workers=num_workers > 0, **loader_kwargs)
+        self.test_loader = pyg.loader.DataLoader(self.test_data, batch_size=batch, **loader_kwargs)
 
         self.model = model
         self.n_epochs = n_epochs
+        self.debug_anomaly = debug_anomaly
+        self.amp = amp and self.device.type == 'cuda'
 
 
         if optimizer == 'adam':
@@ -51,7 +65,6 @@ class TrainModel():
 
         self.loss_func = loss_func
 
-        self.device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
         torch.manual_seed(0)
         np.random.seed(0)
         
@@ -64,10 +77,12 @@ class TrainModel():
 
         name = str(type(self.model)).split('.')[-1][:-2]
         path = Path('results') / name
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp)
 
         for epoch in trange(self.n_epochs, desc='training', unit='epoch'):
             #bunny(epoch)
-            epoch_loss = 0
+            #accumulated on the device so the loss is only synced with the host once per epoch
+            epoch_loss = torch.zeros((), device=self.device)
             
             if (epoch == 25):
                 for param_group in self.optimizer.param_groups:
@@ -85,30 +100,30 @@ class TrainModel():
             self.lr.append(lr)
             val_loss = torch.inf
             with tqdm(self.train_loader, unit="batch") as tepoch:
+                tepoch.set_description(f"Epoch {epoch}")
+                tepoch.set_postfix({
+                    'val_loss': self.val_losses[epoch - 1] if epoch > 0 else 'na',
+                    'val_loss_degrees': self.val_losses[epoch - 1] * 180/pi if epoch > 0 else 'na',
+                    'max_loss_degree': self.max_losses[epoch - 1] * 180/pi if epoch >0 else 'na',
+                    'lr': lr
+                    })
                 for i, data in enumerate(tepoch):
-                    tepoch.set_description(f"Epoch {epoch}")
-                    with torch.autograd.detect_anomaly():
-                        data = data.to(self.device)
+                    #anomaly detection slows autograd down considerably, only turn it on to debug NaNs
+                    anomaly_ctx = torch.autograd.detect_anomaly() if self.debug_anomaly else contextlib.nullcontext()
+                    with anomaly_ctx:
+                        data = data.to(self.device, non_blocking=True)
                         self.optimizer.zero_grad()
-                        end_point = self.model(data)
-                        loss = self.loss_func(end_point, data.y)
-                        loss.backward()
-                        self.optimizer.step()
-                        lr = self.optimizer.param_groups[0]['lr']
+                        with torch.cuda.amp.autocast(enabled=self.amp):
+                            end_point = self.model(data)
+                            loss = self.loss_func(end_point, data.y)
+                        self.scaler.scale(loss).backward()
+                        self.scaler.step(self.optimizer)
+                        self.scaler.update()
 
-                        epoch_loss += loss.detach().item()
-                    
-                        tepoch.set_postfix({
-                            'train_loss': epoch_loss / (i + 1), 
-                            'train_loss_degrees': epoch_loss / (i + 1) * 180/pi, 
-                            'val_loss': self.val_losses[epoch - 1] if epoch > 0 else 'na',
-                            'val_loss_degrees': self.val_losses[epoch - 1] * 180/pi if epoch > 0 else 'na',
-                            'max_loss_degree': self.max_losses[epoch - 1] * 180/pi if epoch >0 else 'na',
-                            'lr': lr
-                            })
+                        epoch_loss += loss.detach() * data.num_graphs
 
                 #self.scheduler.step(val_loss)
-                epoch_loss /= i + 1
+                epoch_loss = (epoch_loss / len(self.train_data)).item()
                 val_loss, max_loss = self.validate()
                 self.max_losses.append(max_loss)
                 tepoch.set_postfix({'train_loss': epoch_loss, 'val_loss': val_loss})
@@ -119,26 +134,31 @@ class TrainModel():
         torch.save(self.model, path / 'model.pt')
 
     def validate(self):
-        loss = 0
+        loss = torch.zeros((), device=self.device)
         losses = []
+        #unreduced copy of the criterion gives the loss of every graph in the batch, so max_loss stays the worst single sample
+        sample_loss_func = type(self.loss_func)(reduction='none')
         for i, data in enumerate(self.val_loader):      
-            data = data.to(self.device)
-            end_point = self.model(data)
-            l = self.loss_func(end_point, data.y).detach().item()
-            loss += l
-            losses.append(l)
+            data = data.to(self.device, non_blocking=True)
+            with torch.cuda.amp.autocast(enabled=self.amp):
+                end_point = self.model(data)
+
+                sample_losses = sample_loss_func(end_point, data.y).detach().mean(dim=1)
+                loss += sample_losses.sum()
+            losses.append(sample_losses)
         loss /= len(self.val_data)
-        return loss, max(losses)
+        return loss.item(), torch.cat(losses).max().item()
     
     def test(self):
-        loss = 0
+        loss = torch.zeros((), device=self.device)
         for i, data in enumerate(self.test_loader):      
-            data = data.to(self.device)
-            end_point = self.model(data)
+            data = data.to(self.device, non_blocking=True)
+            with torch.cuda.amp.autocast(enabled=self.amp):
+                end_point = self.model(data)
 
-            loss += self.loss_func(end_point, data.y).detach().item()
+                loss += self.loss_func(end_point, data.y).detach() * data.num_graphs
         loss /= len(self.test_data)
-        return loss
+        return loss.item()
 
     def augment(self, batch):
         pass